@@ -0,0 +1,64 @@
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True, nogil=True)
+def burn_polygons(
+    coords_flat: np.ndarray,
+    offsets: np.ndarray,
+    row_starts: np.ndarray,
+    row_ends: np.ndarray,
+    values: np.ndarray,
+    events: np.ndarray,
+    x_min: float,
+    y_max: float,
+    resolution: float,
+) -> None:
+    """
+    Records the pixel spans covered by each polygon as start/end events.
+
+    Each covered run of a row adds the polygon value at its first column and
+    subtracts it one past its last column, so a cumulative sum along the rows
+    of events gives the per pixel total. A pixel is covered when its centre
+    falls inside the polygon, matching rasterio.features.rasterize.
+
+    Args:
+        coords_flat (np.ndarray): (N, 2) float64 array of closed exterior ring coordinates.
+        offsets (np.ndarray): Start index of each ring in coords_flat, plus a final end index.
+        row_starts (np.ndarray): First row each polygon can cover.
+        row_ends (np.ndarray): Row after the last one each polygon can cover.
+        values (np.ndarray): The value to add for each polygon.
+        events (np.ndarray): (height, width + 1) signed array the events are added to.
+        x_min (float): The minimum x-coordinate of the raster.
+        y_max (float): The maximum y-coordinate of the raster.
+        resolution (float): The resolution of the raster.
+    """
+    height = events.shape[0]
+    width = events.shape[1] - 1
+    for polygon in range(offsets.shape[0] - 1):
+        start = offsets[polygon]
+        end = offsets[polygon + 1]
+        row_start = max(row_starts[polygon], 0)
+        row_end = min(row_ends[polygon], height)
+
+        for row in range(row_start, row_end):
+            y = y_max - (row + 0.5) * resolution
+            crossings = np.empty(end - start)
+            count = 0
+            for i in range(start, end - 1):
+                x0, y0 = coords_flat[i, 0], coords_flat[i, 1]
+                x1, y1 = coords_flat[i + 1, 0], coords_flat[i + 1, 1]
+                if (y0 <= y < y1) or (y1 <= y < y0):
+                    crossings[count] = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+                    count += 1
+            crossings = np.sort(crossings[:count])
+
+            # Emit the run of pixel centres between each pair of crossings
+            for k in range(0, count - 1, 2):
+                col_start = int(np.ceil((crossings[k] - x_min) / resolution - 0.5))
+                col_end = int(np.ceil((crossings[k + 1] - x_min) / resolution - 0.5))
+                col_start = max(col_start, 0)
+                col_end = min(col_end, width)
+                if col_start < col_end:
+                    events[row, col_start] += values[polygon]
+                    events[row, col_end] -= values[polygon]
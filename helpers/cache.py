@@ -0,0 +1,91 @@
+import io
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Optional, Union
+
+import numpy as np
+
+
+class SceneCache:
+    """Store of scene footprints on disk, keyed by MGRS tile and year range.
+
+    The footprints of each query are saved as a single .npz blob in a SQLite
+    table, so re-running with the same years skips the STAC search entirely.
+    The cache can be shared between query threads, and closes its connection
+    when used as a context manager.
+
+    Args:
+        path (Union[Path, str]): Path of the SQLite database, created if missing.
+    """
+
+    def __init__(self, path: Union[Path, str]):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS scenes ("
+                "name TEXT, min_year INTEGER, max_year INTEGER, rings BLOB, "
+                "PRIMARY KEY (name, min_year, max_year))"
+            )
+
+    def __enter__(self) -> "SceneCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def get(
+        self, name: str, min_year: int, max_year: int
+    ) -> Optional[List[np.ndarray]]:
+        """Return the cached footprints of a tile, or None if it was never stored.
+
+        Args:
+            name (str): The MGRS tile name.
+            min_year (int): The starting year of the query.
+            max_year (int): The ending year of the query.
+
+        Returns:
+            Optional[List[np.ndarray]]: The exterior ring of each scene.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT rings FROM scenes WHERE name=? AND min_year=? AND max_year=?",
+                (name, min_year, max_year),
+            ).fetchone()
+        if row is None:
+            return None
+        with np.load(io.BytesIO(row[0])) as blob:
+            coords, lengths = blob["coords"], blob["lengths"]
+        if len(lengths) == 0:
+            return []
+        return np.split(coords, np.cumsum(lengths)[:-1])
+
+    def put(
+        self, name: str, min_year: int, max_year: int, rings: List[np.ndarray]
+    ) -> None:
+        """Store the footprints of a tile.
+
+        Args:
+            name (str): The MGRS tile name.
+            min_year (int): The starting year of the query.
+            max_year (int): The ending year of the query.
+            rings (List[np.ndarray]): The exterior ring of each scene.
+        """
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            coords=np.concatenate(rings) if rings else np.empty((0, 2)),
+            lengths=np.array([len(ring) for ring in rings], dtype=np.int64),
+        )
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?)",
+                (name, min_year, max_year, buffer.getvalue()),
+            )
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._lock:
+            self._connection.close()
@@ -1,47 +1,109 @@
+from collections import Counter
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
-from typing import List, Optional, Union, Tuple
+from tempfile import TemporaryDirectory
+from typing import List, Optional, Tuple, Union
 
 import geopandas as gpd
 import numpy as np
-from geopandas import GeoSeries
-from pystac.item import Item
-from shapely.geometry import Polygon
+import numpy.typing as npt
+import shapely
 from tqdm.auto import tqdm
 
-from helpers.network import download_index, get_scenes
-from helpers.raster import export_raster, rasterize_scenes
+from helpers.cache import SceneCache
+from helpers.network import QUERY_WORKERS, download_index, get_scenes
+from helpers.raster import (
+    create_raster,
+    export_raster,
+    merge_scene_raster,
+    rasterize_scenes,
+)
+
+
+def get_coverage(scenes: List[np.ndarray]) -> gpd.GeoDataFrame:
+    # Repeat acquisitions of a tile often share an identical footprint, so keep
+    # one polygon per footprint along with the number of scenes it represents
+    unique_rings = {}
+    counts: Counter = Counter()
+    for ring in scenes:
+        key = ring.tobytes()
+        unique_rings.setdefault(key, ring)
+        counts[key] += 1
+    if not unique_rings:
+        return gpd.GeoDataFrame(
+            {"count": []}, geometry=[], crs="EPSG:4326"  # type: ignore
+        )
+
+    # Build every footprint in one vectorized shapely call
+    rings = list(unique_rings.values())
+    ring_index = np.repeat(np.arange(len(rings)), [len(ring) for ring in rings])
+    linear_rings = shapely.linearrings(np.concatenate(rings), indices=ring_index)
+    extents = shapely.polygons(linear_rings)
+
+    extent_gdf = gpd.GeoDataFrame(
+        {"count": [counts[key] for key in unique_rings]},
+        geometry=extents,
+        crs="EPSG:4326",
+    )
+    return extent_gdf
 
 
-def get_coverage(scenes: List[Item]) -> gpd.GeoDataFrame:
-    extents = []
-    for scene in scenes:
-        if scene.geometry is not None and "coordinates" in scene.geometry:
-            extents.append(Polygon(scene.geometry["coordinates"][0]))
+def filter_to_aoi(
+    s2_index_gdf: gpd.GeoDataFrame, aoi_path: Union[Path, str]
+) -> gpd.GeoDataFrame:
+    """
+    Keep only the MGRS tiles that intersect an area of interest.
 
-    extent_gdf = gpd.GeoDataFrame(geometry=extents, crs="EPSG:4326")  # type: ignore
-    return extent_gdf
+    An area of interest without a CRS (e.g. a shapefile missing its .prj) is
+    assumed to be in the CRS of the tile index.
+
+    Args:
+        s2_index_gdf (gpd.GeoDataFrame): The Sentinel-2 tile index.
+        aoi_path (Union[Path, str]): Path to a vector file of the area of interest.
+
+    Returns:
+        gpd.GeoDataFrame: The tiles intersecting any geometry in the area of interest.
+
+    Raises:
+        ValueError: If no tile intersects the area of interest.
+    """
+    aoi_gdf = gpd.read_file(aoi_path)
+    if aoi_gdf.crs is None:
+        aoi_gdf = aoi_gdf.set_crs(s2_index_gdf.crs)
+    aoi_gdf = aoi_gdf.to_crs(s2_index_gdf.crs)
+    tree = shapely.STRtree(s2_index_gdf.geometry.values)
+    _, tile_index = tree.query(aoi_gdf.geometry.values, predicate="intersects")
+    if len(tile_index) == 0:
+        raise ValueError(
+            f"No Sentinel-2 tiles intersect the area of interest {aoi_path}"
+        )
+    return s2_index_gdf.iloc[np.unique(tile_index)]
 
 
 def process_scene(
-    row: Tuple[int, GeoSeries],
+    name: str,
+    geom_geojson: str,
     min_year: int,
     max_year: int,
-    retries: int = 3,
-):
+    raster_shape: Tuple[int, int],
+    dtype: npt.DTypeLike,
+    resolution: float,
+    x_min: float,
+    y_max: float,
+    cache: Optional[SceneCache] = None,
+) -> Optional[Tuple[Tuple[int, int, int, int], np.ndarray]]:
     try:
-        scenes = get_scenes(row[1], min_year, max_year)
+        scenes = get_scenes(name, geom_geojson, min_year, max_year, cache)
         if not scenes:
             return None
         extents = get_coverage(scenes)
-        return extents
+        return rasterize_scenes(extents, raster_shape, dtype, resolution, x_min, y_max)
 
     except Exception as e:
-        if retries > 0:
-            return process_scene(row, min_year, max_year, retries - 1)
-        else:
-            print(e)
-            return None
+        print(e)
+        return None
 
 
 def build_revisit_raster(
@@ -52,14 +114,18 @@ def build_revisit_raster(
     count_limit: Optional[int] = None,
     debug_mode: bool = False,
     scenes_path: Optional[Union[Path, str]] = None,
+    dtype: npt.DTypeLike = np.uint16,
+    aoi_path: Optional[Union[Path, str]] = None,
+    cache_path: Optional[Union[Path, str]] = Path.cwd() / "S2 scenes.sqlite",
 ) -> Path:
     """
     Downloads the Sentinel-2 index, calculates the extent of a global raster based
     on specified parameters, and exports the resulting raster to a given path.
 
     This function generates a global raster by processing Sentinel-2 scenes within
-    a specified time frame and geographical extent. It uses a ThreadPoolExecutor to
-    parallelize the processing of individual scenes.
+    a specified time frame and geographical extent. The raster is sized from the
+    bounds of the tile index, then a ThreadPoolExecutor with QUERY_WORKERS threads
+    queries and rasterizes each tile while this thread merges the results.
 
     Args:
         export_path (Path): The file path where the output raster is to be saved.
@@ -67,7 +133,15 @@ def build_revisit_raster(
         resolution (float): The spatial resolution of the output raster in degrees. Defaults to 0.00278.
         min_year (int): The starting year for Sentinel-2 scene selection. Defaults to 2023.
         max_year (int): The ending year for Sentinel-2 scene selection. Defaults to 2023.
-
+        dtype (npt.DTypeLike): Data type of the revisit raster. Defaults to uint16. Pass
+                               np.uint8 to halve memory when no pixel is revisited more
+                               than 255 times; larger counts are clipped with a warning.
+        aoi_path (Path): Optional vector file of the area of interest. Only MGRS tiles
+                         intersecting it are queried, which skips tiles with no scenes.
+        cache_path (Path): SQLite file caching the scene footprints of each tile for past
+                           years, so re-runs skip the STAC queries. Defaults to
+                           'S2 scenes.sqlite' in the current working directory.
+                           Pass None to disable.
 
     Returns:
         None: The function does not return a value but exports the generated raster to the specified path.
@@ -76,53 +150,66 @@ def build_revisit_raster(
         s2_index_path = scenes_path
     else:
         s2_index_path = download_index()
-    s2_index_gdf = gpd.read_file(s2_index_path)
+    # Read through GDAL directly, materializing only the tile names and geometry
+    s2_index_gdf = gpd.read_file(s2_index_path, engine="pyogrio", columns=["Name"])
 
+    if aoi_path is not None:
+        s2_index_gdf = filter_to_aoi(s2_index_gdf, aoi_path)
     if count_limit is not None:
         s2_index_gdf = s2_index_gdf.head(count_limit)
-    if debug_mode:
-        result = []
-        for row in tqdm(
-            s2_index_gdf.iterrows(), total=len(s2_index_gdf), desc="Querying scenes"
-        ):
-            result.append(process_scene(row, min_year=min_year, max_year=max_year))  # type: ignore
-    else:
-        with ThreadPoolExecutor() as executor:
-            result = list(
-                tqdm(
-                    executor.map(
-                        process_scene,
-                        s2_index_gdf.iterrows(),
-                        [min_year] * len(s2_index_gdf),
-                        [max_year] * len(s2_index_gdf),
-                    ),
-                    total=len(s2_index_gdf),
-                    desc="Querying scenes",
-                )
-            )
-
-    x_min, y_min = float("inf"), float("inf")
-    x_max, y_max = float("-inf"), float("-inf")
-
-    for gdf in result:
-        if gdf is not None:
-            extent = gdf.total_bounds
-            x_min = min(x_min, extent[0])
-            y_min = min(y_min, extent[1])
-            x_max = max(x_max, extent[2])
-            y_max = max(y_max, extent[3])
 
+    # Pull the columns out once instead of building a Series per tile
+    names = s2_index_gdf["Name"].to_numpy()
+    geom_geojsons = shapely.to_geojson(
+        shapely.buffer(s2_index_gdf.geometry.values, -0.1)
+    )
+
+    # Scene footprints lie within their MGRS tiles, so the tile index bounds the
+    # raster and it can be allocated before any scenes are queried
+    x_min, y_min, x_max, y_max = s2_index_gdf.total_bounds
     width = int((x_max - x_min) / resolution)
     height = int((y_max - y_min) / resolution)
-    global_raster = np.zeros((height, width), dtype=np.uint16)
-
-    for gdf in tqdm(result, desc="Rasterizing scenes"):
-        if gdf is not None:
-            global_raster = rasterize_scenes(
-                gdf, global_raster, resolution, x_min, y_max
-            )
 
-    export_raster(
-        global_raster, x_min, y_min, x_max, y_max, width, height, Path(export_path)
-    )
+    cache_context = SceneCache(cache_path) if cache_path is not None else nullcontext()
+    # Keep the backing file on the export's disk, the system temp dir may be RAM backed
+    with cache_context as cache, TemporaryDirectory(
+        dir=Path(export_path).parent
+    ) as raster_dir:
+        global_raster = create_raster(height, width, Path(raster_dir), dtype)
+        process = partial(
+            process_scene,
+            min_year=min_year,
+            max_year=max_year,
+            raster_shape=global_raster.shape,
+            dtype=dtype,
+            resolution=resolution,
+            x_min=x_min,
+            y_max=y_max,
+            cache=cache,
+        )
+
+        if debug_mode:
+            for tile in tqdm(
+                map(process, names, geom_geojsons),
+                total=len(names),
+                desc="Processing scenes",
+            ):
+                if tile is not None:
+                    global_raster = merge_scene_raster(global_raster, *tile)
+        else:
+            # Workers query and rasterize tiles, but only this thread writes the raster
+            with ThreadPoolExecutor(max_workers=QUERY_WORKERS) as executor:
+                for tile in tqdm(
+                    executor.map(process, names, geom_geojsons),
+                    total=len(names),
+                    desc="Processing scenes",
+                ):
+                    if tile is not None:
+                        global_raster = merge_scene_raster(global_raster, *tile)
+
+        export_raster(
+            global_raster, x_min, y_min, x_max, y_max, width, height, Path(export_path)
+        )
+        # Release the mapping so the backing file can be removed
+        del global_raster
     return Path(export_path)
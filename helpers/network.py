@@ -1,37 +1,112 @@
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
+import numpy as np
 import pystac_client
 import requests
-import shapely
-from geopandas import GeoSeries
-from pystac.item import Item
+from pystac_client.exceptions import APIError
+from pystac_client.stac_api_io import StacApiIO
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from helpers.cache import SceneCache
+
+STAC_URL = "https://planetarycomputer.microsoft.com/api/stac/v1"
+
+# STAC queries are latency bound, so run far more of them than there are cores
+QUERY_WORKERS = 64
+
+# Make up to 3 attempts at throttled, failed or stalled searches. urllib3 retries
+# the first failure at once, then backs off exponentially (2s before the third)
+QUERY_RETRY = Retry(
+    total=2,
+    backoff_factor=1,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=None,
+)
+
+# Seconds to wait on a connection or response before the attempt counts as failed
+QUERY_TIMEOUT = 60
+
+_CATALOG: Optional[pystac_client.Client] = None
+_CATALOG_LOCK = threading.Lock()
+
+
+def get_catalog() -> pystac_client.Client:
+    """Return the shared Planetary Computer catalog, opening it on first use.
+
+    Reusing one client avoids fetching the STAC root on every query and lets all
+    query threads share its pooled HTTPS connections.
+
+    Returns:
+        pystac_client.Client: The Planetary Computer STAC client.
+    """
+    global _CATALOG
+    with _CATALOG_LOCK:
+        if _CATALOG is None:
+            stac_io = StacApiIO(timeout=QUERY_TIMEOUT)
+            # Keep a connection alive for every query thread, not urllib3's default 10
+            stac_io.session.mount(
+                "https://",
+                HTTPAdapter(pool_maxsize=QUERY_WORKERS, max_retries=QUERY_RETRY),
+            )
+            _CATALOG = pystac_client.Client.open(STAC_URL, stac_io=stac_io)
+    return _CATALOG
 
 
 def get_scenes(
-    row: GeoSeries, extract_start_year: int, extract_end_year: int, retry: int = 3
-) -> List[Item]:
-    bounds = row.geometry.buffer(-0.1)
+    name: str,
+    geom_geojson: str,
+    extract_start_year: int,
+    extract_end_year: int,
+    cache: Optional[SceneCache] = None,
+) -> List[np.ndarray]:
+    if cache is not None:
+        try:
+            rings = cache.get(name, extract_start_year, extract_end_year)
+        except sqlite3.Error as e:
+            # Treat an unreadable cache as a miss and query the tile instead
+            print(f"{name}: could not read cached scenes, {e}")
+            rings = None
+        if rings is not None:
+            return rings
 
     query = {
         "collections": ["sentinel-2-l2a"],
-        "intersects": shapely.to_geojson(bounds),
+        "intersects": geom_geojson,
         "datetime": f"{extract_start_year}-01-01T00:00:00Z/{extract_end_year}-12-31T23:59:59Z",
-        "query": {"s2:mgrs_tile": {"eq": row.Name}},
+        "query": {"s2:mgrs_tile": {"eq": name}},
+        # Only the footprints are used, so skip assets, properties and links
+        "fields": {
+            "include": ["geometry"],
+            "exclude": ["assets", "properties", "links", "stac_extensions"],
+        },
+        "limit": 1000,
     }
-    catalog = pystac_client.Client.open(
-        "https://planetarycomputer.microsoft.com/api/stac/v1",
-    )
     try:
-        item_collection = catalog.search(**query).item_collection()
-        items = list(item_collection)
-    except:
-        if retry > 0:
-            return get_scenes(row, extract_start_year, extract_end_year, retry - 1)
-        else:
-            return []
+        features = get_catalog().search(**query).items_as_dicts()
+        rings = [
+            np.asarray(feature["geometry"]["coordinates"][0], dtype=np.float64)
+            for feature in features
+            if feature.get("geometry") and "coordinates" in feature["geometry"]
+        ]
+    except (APIError, requests.RequestException) as e:
+        # The session has already retried, so give up on this tile
+        print(f"{name}: {e}")
+        return []
 
-    return items
+    # Scenes are still being added for the current year, so only cache past years
+    if cache is not None and extract_end_year < date.today().year:
+        try:
+            cache.put(name, extract_start_year, extract_end_year, rings)
+        except sqlite3.Error as e:
+            # The query succeeded, so keep the tile even if it could not be cached
+            print(f"{name}: could not cache scenes, {e}")
+    return rings
 
 
 urls = [
@@ -44,6 +119,12 @@ urls = [
     "https://raw.githubusercontent.com/justinelliotmeyers/Sentinel-2-Shapefile-Index/master/sentinel_2_index_shapefile.shx",
 ]
 
+# Keep-alive connections shared by the index downloads, one per file
+_DOWNLOAD_SESSION = requests.Session()
+_DOWNLOAD_SESSION.mount(
+    "https://", HTTPAdapter(pool_connections=len(urls), pool_maxsize=len(urls))
+)
+
 
 def download_file(url: str) -> Path:
     """Download a file from a given URL.
@@ -57,7 +138,7 @@ def download_file(url: str) -> Path:
     local_filename = url.split("/")[-1]
     download_folder = Path.cwd() / "S2 index"
     download_folder.mkdir(exist_ok=True)
-    with requests.get(url, stream=True) as r:
+    with _DOWNLOAD_SESSION.get(url, stream=True) as r:
         r.raise_for_status()
         dl_path = download_folder / local_filename
         if dl_path.exists():
@@ -74,5 +155,6 @@ def download_index() -> Path:
     Returns:
         Path: The path to the downloaded .shp file.
     """
-    downloaded_files = [download_file(url) for url in urls]
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        downloaded_files = list(executor.map(download_file, urls))
     return downloaded_files[5]
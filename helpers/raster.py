@@ -1,105 +1,161 @@
+import warnings
 from pathlib import Path
 from typing import Tuple
 
 import geopandas as gpd
 import numpy as np
+import numpy.typing as npt
 import rasterio as rio
-from rasterio.features import rasterize
+import shapely
+from rasterio.windows import Window
 
+from helpers._raster_numba import burn_polygons
 
-def get_index(
-    bbox: Tuple[float, float, float, float], minx: float, miny: float, resolution: float
-) -> Tuple[int, int, int, int]:
+# Tile size of the exported GeoTIFF, in pixels
+EXPORT_BLOCK_SIZE = 512
+
+
+def get_indices(
+    bboxes: np.ndarray, x_min: float, y_max: float, resolution: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """
-    Calculate row and column start and end indices from a bounding box.
+    Calculate row and column start and end indices for many bounding boxes at once.
 
     Args:
-        bbox (Tuple[float, float, float, float]): The bounding box as a tuple (minx, miny, maxx, maxy).
-        minx (float): Minimum x-value of the bounding box.
-        miny (float): Maximum y-value of the bounding box.
+        bboxes (np.ndarray): (N, 4) array of bounding boxes as (minx, miny, maxx, maxy) rows.
+        x_min (float): The minimum x-coordinate of the raster.
+        y_max (float): The maximum y-coordinate of the raster.
         resolution (float): Resolution of the raster.
 
     Returns:
-        Tuple[int, int, int, int]: Tuple of (row_start, row_end, col_start, col_end) indices.
+        Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Arrays of (row_start,
+        row_end, col_start, col_end) indices, one element per bounding box.
     """
-    col_start = int((bbox[0] - minx) / resolution)
-    row_start = int((miny - bbox[3]) / resolution)
-    col_end = int((bbox[2] - minx) / resolution)
-    row_end = int((miny - bbox[1]) / resolution)
+    col_start = ((bboxes[:, 0] - x_min) / resolution).astype(np.int64)
+    row_start = ((y_max - bboxes[:, 3]) / resolution).astype(np.int64)
+    col_end = ((bboxes[:, 2] - x_min) / resolution).astype(np.int64)
+    row_end = ((y_max - bboxes[:, 1]) / resolution).astype(np.int64)
     return row_start, row_end, col_start, col_end
 
 
+def create_raster(
+    height: int, width: int, directory: Path, dtype: npt.DTypeLike = np.uint16
+) -> np.memmap:
+    """
+    Create a zero filled raster backed by a temporary file rather than RAM.
+
+    The operating system only keeps the pages that are being written in memory,
+    so a global raster far larger than the available RAM can be accumulated.
+
+    Args:
+        height (int): Height of the raster in pixels.
+        width (int): Width of the raster in pixels.
+        directory (Path): Directory to hold the backing file.
+        dtype (npt.DTypeLike): Data type of the raster. Defaults to uint16.
+
+    Returns:
+        np.memmap: The writable raster array.
+    """
+    return np.memmap(
+        directory / "global_raster.dat",
+        dtype=dtype,
+        mode="w+",
+        shape=(height, width),
+    )
+
+
 def rasterize_scenes(
     gdf: gpd.GeoDataFrame,
-    global_raster: np.ndarray,
+    raster_shape: Tuple[int, int],
+    dtype: npt.DTypeLike,
     resolution: float,
     x_min: float,
     y_max: float,
-) -> np.ndarray:
+) -> Tuple[Tuple[int, int, int, int], np.ndarray]:
     """
-    Rasterizes polygons in a GeoDataFrame onto a global raster array.
+    Rasterizes polygons in a GeoDataFrame onto the window of the global raster they cover.
+
+    The global raster itself is not touched, so tiles can be rasterized in parallel
+    and merged afterwards with merge_scene_raster.
 
     Args:
-        gdf (gpd.GeoDataFrame): GeoDataFrame containing polygons to rasterize.
-        global_raster (np.ndarray): The global raster array to rasterize onto.
+        gdf (gpd.GeoDataFrame): GeoDataFrame containing polygons to rasterize, with a
+                                'count' column giving the value each polygon adds.
+        raster_shape (Tuple[int, int]): The (height, width) of the global raster.
+        dtype (npt.DTypeLike): The data type of the global raster.
         resolution (float): The resolution of the raster.
         x_min (float): The minimum x-coordinate of the global raster.
         y_max (float): The maximum y-coordinate of the global raster.
 
     Returns:
-        np.ndarray: The updated global raster array with the rasterized polygons.
+        Tuple[Tuple[int, int, int, int], np.ndarray]: The (min_row, max_row, min_col,
+        max_col) window in the global raster and the rasterized polygons for it.
     """
 
-    # Rasterize each polygon
-    rasters = []
-    raster_bounds = []
-
-    for polygon in gdf.geometry:
-        bbox = polygon.bounds
-        bbox_width = int((bbox[2] - bbox[0]) / resolution)
-        bbox_height = int((bbox[3] - bbox[1]) / resolution)
-        transform = rio.transform.from_origin(bbox[0], bbox[3], resolution, resolution)  # type: ignore
-
-        # Rasterize the polygon within its bounding box
-        rasterized = rasterize(
-            [(polygon, 1)],
-            out_shape=(bbox_height, bbox_width),
-            transform=transform,
-            dtype="uint16",
-        )
-
-        # Get indices in the global raster
-        row_start, row_end, col_start, col_end = get_index(
-            bbox, x_min, y_max, resolution
+    # Snap every polygon to the global raster grid, then take the covering window
+    row_starts, row_ends, col_starts, col_ends = get_indices(
+        shapely.bounds(gdf.geometry.values), x_min, y_max, resolution
+    )
+    min_row = max(int(row_starts.min()), 0)
+    max_row = max(min(int(row_ends.max()) + 1, raster_shape[0]), min_row)
+    min_col = max(int(col_starts.min()), 0)
+    max_col = max(min(int(col_ends.max()) + 1, raster_shape[1]), min_col)
+
+    # Scan convert every exterior ring into span events, then sum along rows
+    coords, ring_index = shapely.get_coordinates(
+        shapely.get_exterior_ring(gdf.geometry.values), return_index=True
+    )
+    offsets = np.zeros(len(gdf) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(ring_index, minlength=len(gdf)))
+    events = np.zeros((max_row - min_row, max_col - min_col + 1), dtype=np.int32)
+    burn_polygons(
+        coords,
+        offsets,
+        row_starts - min_row,
+        row_ends + 1 - min_row,
+        gdf["count"].to_numpy(dtype=np.int32),
+        events,
+        x_min + min_col * resolution,
+        y_max - min_row * resolution,
+        resolution,
+    )
+    # Sum in place so the final cast is the only new array
+    np.cumsum(events, axis=1, out=events)
+    dtype_max = np.iinfo(dtype).max
+    if events.size and events.max() > dtype_max:
+        warnings.warn(
+            f"Revisit counts above {dtype_max} were clipped to fit {np.dtype(dtype)}, "
+            "use a wider dtype to keep them",
+            stacklevel=2,
         )
+        np.minimum(events, dtype_max, out=events)
+    scene_raster = events[:, :-1].astype(dtype)
 
-        rasters.append(rasterized)
-        raster_bounds.append((row_start, row_end, col_start, col_end))
-
-    min_row = np.min([r[0] for r in raster_bounds])
-    max_row = np.max([r[1] for r in raster_bounds])
+    return (min_row, max_row, min_col, max_col), scene_raster
 
-    min_col = np.min([r[2] for r in raster_bounds])
-    max_col = np.max([r[3] for r in raster_bounds])
 
-    scene_raster = np.zeros((max_row - min_row, max_col - min_col)).astype("uint16")
+def merge_scene_raster(
+    global_raster: np.ndarray,
+    window: Tuple[int, int, int, int],
+    scene_raster: np.ndarray,
+) -> np.ndarray:
+    """
+    Merges a rasterized tile into the global raster, keeping the higher count.
 
-    # Add the rasterized polygon to the global raster
-    for rasterized, (row_start, row_end, col_start, col_end) in zip(
-        rasters, raster_bounds
-    ):
-        scene_raster[
-            row_start - min_row : row_start - min_row + rasterized.shape[0],
-            col_start - min_col : col_start - min_col + rasterized.shape[1],
-        ] += rasterized
+    Args:
+        global_raster (np.ndarray): The global raster array to merge into.
+        window (Tuple[int, int, int, int]): The (min_row, max_row, min_col, max_col)
+                                            window the tile covers.
+        scene_raster (np.ndarray): The rasterized tile from rasterize_scenes.
 
+    Returns:
+        np.ndarray: The updated global raster array.
+    """
+    min_row, max_row, min_col, max_col = window
     global_raster_slice = global_raster[min_row:max_row, min_col:max_col]
 
-    global_raster_slice = np.where(
-        scene_raster > global_raster_slice, scene_raster, global_raster_slice
-    ).astype("uint16")
-
-    global_raster[min_row:max_row, min_col:max_col] = global_raster_slice
+    # The slice is a view, so this writes straight into the global raster
+    np.maximum(global_raster_slice, scene_raster, out=global_raster_slice)
 
     return global_raster
 
@@ -118,7 +174,8 @@ def export_raster(
 
     This function saves a NumPy array as a geospatial raster in GeoTIFF format,
     using the rasterio library. It requires the bounds of the raster in geographical
-    coordinates and the dimensions of the output file.
+    coordinates and the dimensions of the output file. The file is tiled and ZSTD
+    compressed on all CPUs, and written one row of tiles at a time.
 
     Args:
         global_raster (np.ndarray): The raster data as a NumPy array.
@@ -142,7 +199,20 @@ def export_raster(
         nodata=0,
         dtype=global_raster.dtype,
         crs="+proj=latlong",
-        compress="lzw",
+        tiled=True,
+        blockxsize=EXPORT_BLOCK_SIZE,
+        blockysize=EXPORT_BLOCK_SIZE,
+        compress="zstd",
+        zstd_level=3,
+        num_threads="ALL_CPUS",
+        bigtiff="YES",
         transform=rio.transform.from_bounds(x_min, y_min, x_max, y_max, width, height),  # type: ignore
     ) as dst:
-        dst.write(global_raster, 1)
+        # Write one row of blocks at a time so only that band is read from the memmap
+        for row in range(0, height, EXPORT_BLOCK_SIZE):
+            band_height = min(EXPORT_BLOCK_SIZE, height - row)
+            dst.write(
+                global_raster[row : row + band_height],
+                1,
+                window=Window(0, row, width, band_height),  # type: ignore
+            )